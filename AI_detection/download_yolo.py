@@ -4,31 +4,36 @@ Download YOLO model files for AI presence detection
 
 import requests
 import os
+import shutil
 from urllib.parse import urlparse
 
+CHUNK_SIZE = 1024 * 1024  # 1 MiB chunks: fewer syscalls and progress redraws
+
 def download_file(url, filename):
     """Download file with progress indicator"""
     print(f"📥 Downloading {filename}...")
     
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        total_size = int(response.headers.get('content-length', 0))
-        
-        os.makedirs('yolo', exist_ok=True)
-        filepath = os.path.join('yolo', filename)
-        
-        with open(filepath, 'wb') as f:
-            if total_size == 0:
-                f.write(response.content)
-            else:
-                downloaded = 0
-                for chunk in response.iter_content(chunk_size=8192):
-                    downloaded += len(chunk)
-                    f.write(chunk)
-                    percent = (downloaded / total_size) * 100
-                    print(f"\r{'█' * int(percent/2):<50} {percent:.1f}%", end='')
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            
+            total_size = int(response.headers.get('content-length', 0))
+            
+            os.makedirs('yolo', exist_ok=True)
+            filepath = os.path.join('yolo', filename)
+            
+            with open(filepath, 'wb') as f:
+                if total_size == 0:
+                    # Unknown size: stream straight to disk without a progress bar
+                    response.raw.decode_content = True
+                    shutil.copyfileobj(response.raw, f, length=CHUNK_SIZE)
+                else:
+                    downloaded = 0
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        downloaded += len(chunk)
+                        f.write(chunk)
+                        percent = (downloaded / total_size) * 100
+                        print(f"\r{'█' * int(percent/2):<50} {percent:.1f}%", end='')
         
         print(f"\n✅ Downloaded: {filepath} ({os.path.getsize(filepath)} bytes)")
         return True
@@ -4,18 +4,48 @@ Simplified version for real-time Firebase integration
 Based on: https://github.com/g4lb/camera-recorder-with-human-detection
 """
 
+import argparse
 import cv2
 import numpy as np
+import os
 import time
-import json
 import requests
-from datetime import datetime
+import sys
+import threading
+from collections import deque
+from queue import Queue, Empty
+from requests.adapters import HTTPAdapter
+
+def put_latest(q, item):
+    """Put item into a one-slot queue, dropping whatever is still waiting"""
+    try:
+        q.get_nowait()
+    except Empty:
+        pass
+    q.put(item)
 
 class AIPresenceDetector:
-    def __init__(self, firebase_url="http://localhost:9000", room_id="roomA"):
+    # DNN backends in order of preference: (name, backend, target)
+    DNN_BACKENDS = [
+        ("CUDA FP16", cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16),
+        ("CUDA", cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA),
+        ("OpenVINO CPU", cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE, cv2.dnn.DNN_TARGET_CPU),
+        # Integrated GPUs (Intel HD / AMD Vega) through OpenCL, no CUDA needed
+        ("OpenCL FP16", cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_OPENCL_FP16),
+        # CPU FP16 needs OpenCV 4.9+ and an FP16-capable CPU (ARM NEON, AVX512-FP16)
+        ("CPU FP16", cv2.dnn.DNN_BACKEND_OPENCV, getattr(cv2.dnn, "DNN_TARGET_CPU_FP16", None)),
+        ("CPU", cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU),
+    ]
+    
+    def __init__(self, firebase_url="http://localhost:9000", room_id="roomA", input_size=320,
+                 show_window=True, inference_cores=None, camera_source=None):
         """Initialize AI presence detector with Firebase integration"""
         self.firebase_url = firebase_url
         self.room_id = room_id
+        self.state_url = f"{firebase_url}/lighting/{room_id}/state.json"
+        self.show_window = show_window  # Disable for headless/service deployments
+        self.inference_cores = inference_cores  # e.g. {2, 3} to leave cores 0-1 for other services
+        self.camera_source = camera_source  # Optional GStreamer pipeline string (see open_camera)
         
         # Load YOLO model
         self.net = cv2.dnn.readNetFromDarknet(
@@ -23,61 +53,126 @@ class AIPresenceDetector:
             'yolo/yolov3-tiny.weights'
         )
         
-        # Get output layer names
-        layer_names = self.net.getLayerNames()
-        self.output_layers = [layer_names[i[0] - 1] for i in self.net.getUnconnectedOutLayers()]
+        # Get output layer names (works across OpenCV versions)
+        self.output_layers = list(self.net.getUnconnectedOutLayersNames())
         
         # Detection parameters
+        self.input_size = (input_size, input_size)  # Keep a multiple of 32 (320 is plenty for presence)
+        
+        # Preprocessing buffers reused every frame instead of a fresh blob
+        self.resized = np.empty((input_size, input_size, 3), np.uint8)
+        self.blob = np.empty((1, 3, input_size, input_size), np.float32)
+        
+        # Run on the fastest backend that actually works (FP16 tensor cores if present)
+        self.backend_name = self.select_backend()
         self.conf_threshold = 0.5
         self.nms_threshold = 0.4
         
         # Timing control
         self.last_update = 0
         self.update_interval = 2.0  # Update Firebase every 2 seconds
+        self.last_inference = 0
+        self.inference_interval = 0.1  # Run YOLO at most 10 times per second
+        self.last_display = 0
+        self.display_interval = 0.2  # Refresh the preview window at most 5 times per second
         
-        # Detection history for stability
-        self.detection_history = []
+        # Motion gate: skip YOLO while the scene is static
+        self.last_motion_check = 0
+        self.motion_threshold = 2.0  # Mean gray-level change that counts as motion
+        self.static_refresh_interval = 3.0  # Still run YOLO this often on a static scene
+        self.prev_gray = None
+        
+        # Detection history for stability (ring buffer + running count)
         self.history_size = 5
+        self.detection_history = deque(maxlen=self.history_size)
+        self.detection_count = 0
+        
+        # Pre-rendered status overlays keyed by (person_count, presence)
+        self.status_cache = {}
+        
+        # Capture pipeline: only the newest frame is kept for detection
+        self.frame_queue = Queue(maxsize=1)
+        self.display_queue = Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        
+        # Firebase uploads run on a background thread with a keep-alive session
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.upload_queue = Queue(maxsize=1)
         
         print("🤖 AI Presence Detector initialized")
         print(f"📍 Room: {room_id}")
         print(f"🔗 Firebase: {firebase_url}")
+        print(f"⚡ DNN backend: {self.backend_name}")
+    
+    def select_backend(self):
+        """Pick the first DNN backend/target that runs a forward pass on this machine"""
+        for name, backend, target in self.DNN_BACKENDS:
+            if target is None or target not in cv2.dnn.getAvailableTargets(backend):
+                continue
+            
+            # A build can list CUDA/OpenCL targets without a usable device, so try a dummy forward
+            self.net.setPreferableBackend(backend)
+            self.net.setPreferableTarget(target)
+            try:
+                self.blob.fill(0)
+                self.net.setInput(self.blob)
+                self.net.forward(self.output_layers)
+                return name
+            except cv2.error:
+                print(f"⚠️ DNN backend {name} failed a test forward pass, trying the next one")
+        
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        return "Default"
     
     def detect_people(self, frame):
         """Detect people in frame using YOLO"""
-        height, width, channels = frame.shape
+        return self.detect_people_batch([frame])[0]
+    
+    def detect_people_batch(self, frames):
+        """Detect people in several frames (e.g. one per camera) with one forward pass"""
+        batch_size = len(frames)
+        if self.blob.shape[0] != batch_size:
+            self.blob = np.empty((batch_size,) + self.blob.shape[1:], np.float32)
         
-        # Prepare image for YOLO
-        blob = cv2.dnn.blobFromImage(frame, 0.00392, (416, 416), (0, 0, 0), True, crop=False)
-        self.net.setInput(blob)
+        # Prepare images for YOLO (same as blobFromImages with swapRB, into reused buffers)
+        for i, frame in enumerate(frames):
+            cv2.resize(frame, self.input_size, dst=self.resized)
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.resized)
+            np.multiply(self.resized.transpose(2, 0, 1), np.float32(0.00392), out=self.blob[i])
+        self.net.setInput(self.blob)
         outputs = self.net.forward(self.output_layers)
         
-        # Process detections
-        boxes = []
-        confidences = []
-        class_ids = []
+        # Each output head is (rows, 85) for one frame, (batch, rows, 85) for several
+        outputs = [output.reshape(batch_size, -1, output.shape[-1]) for output in outputs]
+        return [self.process_detections([output[i] for output in outputs], frame.shape)
+                for i, frame in enumerate(frames)]
+    
+    def process_detections(self, outputs, frame_shape):
+        """Turn raw YOLO outputs for one frame into NMS-filtered person boxes"""
+        height, width = frame_shape[:2]
         
-        for output in outputs:
-            for detection in output:
-                scores = detection[5:]
-                class_id = np.argmax(scores)
-                confidence = scores[class_id]
-                
-                # Only process person class (ID = 0) with high confidence
-                if class_id == 0 and confidence > self.conf_threshold:
-                    # Object detected
-                    center_x = int(detection[0] * width)
-                    center_y = int(detection[1] * height)
-                    w = int(detection[2] * width)
-                    h = int(detection[3] * height)
-                    
-                    # Rectangle coordinates
-                    x = int(center_x - w / 2)
-                    y = int(center_y - h / 2)
-                    
-                    boxes.append([x, y, w, h])
-                    confidences.append(float(confidence))
-                    class_ids.append(class_id)
+        # Process all detections at once: (N, 85) rows of box + class scores
+        detections = np.concatenate(outputs, axis=0)
+        person_scores = detections[:, 5]  # Class 0 is person
+        
+        # Only keep person class with high confidence
+        mask = person_scores > self.conf_threshold
+        people = detections[mask]
+        
+        center_x = (people[:, 0] * width).astype(int)
+        center_y = (people[:, 1] * height).astype(int)
+        w = (people[:, 2] * width).astype(int)
+        h = (people[:, 3] * height).astype(int)
+        
+        # Rectangle coordinates
+        x = (center_x - w / 2).astype(int)
+        y = (center_y - h / 2).astype(int)
+        
+        boxes = np.stack([x, y, w, h], axis=1).tolist()
+        confidences = person_scores[mask].astype(float).tolist()
         
         # Apply non-maximum suppression
         indexes = cv2.dnn.NMSBoxes(boxes, confidences, self.conf_threshold, self.nms_threshold)
@@ -87,101 +182,241 @@ class AIPresenceDetector:
         
         return person_count, boxes, indexes, confidences
     
+    def scene_changed(self, frame):
+        """Cheap motion check against the previous downscaled grayscale frame"""
+        gray = cv2.cvtColor(cv2.resize(frame, (160, 120)), cv2.COLOR_BGR2GRAY)
+        changed = self.prev_gray is None or cv2.absdiff(gray, self.prev_gray).mean() >= self.motion_threshold
+        self.prev_gray = gray
+        return changed
+    
     def stable_presence_detection(self, person_count):
         """Apply stability filter to reduce false positives"""
-        # Add current detection to history
-        self.detection_history.append(person_count > 0)
+        detected = int(person_count > 0)
         
-        # Keep only recent history
-        if len(self.detection_history) > self.history_size:
-            self.detection_history.pop(0)
+        # Oldest entry is evicted by the deque, keep the running count in sync
+        if len(self.detection_history) == self.history_size:
+            self.detection_count -= self.detection_history[0]
+        self.detection_history.append(detected)
+        self.detection_count += detected
         
         # Require majority of recent frames to have detection
         if len(self.detection_history) >= 3:
-            stable_presence = sum(self.detection_history) >= 2  # 2 out of last frames
+            stable_presence = self.detection_count >= 2  # 2 out of last frames
         else:
             stable_presence = person_count > 0
         
         return stable_presence
     
     def update_firebase(self, presence, person_count):
-        """Update Firebase with presence data"""
-        try:
-            timestamp = int(time.time() * 1000)
-            
-            # Prepare data for Firebase
-            data = {
-                "presence": presence,
-                "personCount": person_count,
-                "ts": timestamp,
-                "source": "AI_Camera"
-            }
-            
-            # Update state
-            state_url = f"{self.firebase_url}/lighting/{self.room_id}/state.json"
-            response = requests.patch(state_url, json=data, timeout=5)
+        """Queue presence data for the Firebase uploader thread"""
+        timestamp = int(time.time() * 1000)
+        
+        # Prepare data for Firebase
+        data = {
+            "presence": presence,
+            "personCount": person_count,
+            "ts": timestamp,
+            "source": "AI_Camera"
+        }
+        
+        # Never block detection on the network; only the latest state matters
+        put_latest(self.upload_queue, data)
+    
+    def firebase_uploader(self):
+        """Upload thread: send queued state updates until a None sentinel"""
+        while True:
+            data = self.upload_queue.get()
+            if data is None:
+                break
             
-            if response.status_code == 200:
-                print(f"✅ Firebase updated: presence={presence}, count={person_count}")
-            else:
-                print(f"❌ Firebase update failed: {response.status_code}")
+            try:
+                # Update state
+                response = self.session.patch(self.state_url, json=data, timeout=5)
                 
-        except Exception as e:
-            print(f"❌ Firebase error: {e}")
+                if response.status_code == 200:
+                    print(f"✅ Firebase updated: presence={data['presence']}, count={data['personCount']}")
+                else:
+                    print(f"❌ Firebase update failed: {response.status_code}")
+                    
+            except Exception as e:
+                print(f"❌ Firebase error: {e}")
     
     def draw_detections(self, frame, boxes, indexes, confidences):
         """Draw detection boxes on frame"""
-        if len(indexes) > 0:
-            for i in indexes.flatten():
-                x, y, w, h = boxes[i]
-                confidence = confidences[i]
-                
-                # Draw bounding box
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                
-                # Draw confidence label
-                label = f"Person: {confidence:.2f}"
-                cv2.putText(frame, label, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        if len(indexes) == 0:
+            return frame
+        
+        indexes = np.asarray(indexes).flatten()
+        x, y, w, h = np.asarray(boxes, np.int32)[indexes].T
+        
+        # Draw all bounding boxes in a single call
+        corners = np.stack([x, y, x + w, y, x + w, y + h, x, y + h], axis=1).reshape(-1, 4, 2)
+        cv2.polylines(frame, corners, True, (0, 255, 0), 2)
+        
+        # Draw confidence labels
+        for i, label_x, label_y in zip(indexes, x.tolist(), (y - 10).tolist()):
+            label = f"Person: {confidences[i]:.2f}"
+            cv2.putText(frame, label, (label_x, label_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
         
         return frame
     
-    def run_detection(self):
-        """Main detection loop"""
-        # Initialize camera
-        cap = cv2.VideoCapture(0)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    def draw_status(self, frame, person_count, stable_presence):
+        """Blit the cached status overlay for the current state onto frame"""
+        key = (person_count, stable_presence)
+        if key not in self.status_cache:
+            # Render the text once on a black strip and remember which pixels it covers
+            status_text = f"People: {person_count} | Presence: {stable_presence}"
+            (text_w, text_h), baseline = cv2.getTextSize(status_text, cv2.FONT_HERSHEY_SIMPLEX, 0.7, 2)
+            overlay = np.zeros((30 + baseline + 2, 10 + text_w + 2, 3), np.uint8)
+            cv2.putText(overlay, status_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+            self.status_cache[key] = (overlay, overlay.any(axis=2, keepdims=True))
         
-        if not cap.isOpened():
-            print("❌ Error: Could not open camera")
+        overlay, mask = self.status_cache[key]
+        region = frame[:overlay.shape[0], :overlay.shape[1]]
+        rows, cols = region.shape[:2]
+        np.copyto(region, overlay[:rows, :cols], where=mask[:rows, :cols])
+        return frame
+    
+    def capture_frames(self, cap):
+        """Capture thread: keep only the latest frame in the queue"""
+        while not self.stop_event.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                self.stop_event.set()
+                break
+            
+            # Drop the stale frame so detection never falls behind the camera
+            put_latest(self.frame_queue, frame)
+    
+    def pin_inference_thread(self):
+        """Keep this thread and OpenCV's workers on inference_cores (Linux only)"""
+        if not self.inference_cores:
+            return
+        if not hasattr(os, "sched_setaffinity"):
+            print("⚠️ CPU pinning is not supported on this platform")
             return
         
-        print("🎥 Camera started - Press 'q' to quit")
+        # Affinity first: the worker pool recreated by setNumThreads inherits it
+        os.sched_setaffinity(0, self.inference_cores)
+        cv2.setNumThreads(len(self.inference_cores))
+        print(f"📌 Inference pinned to cores {sorted(self.inference_cores)}")
+    
+    def inference_loop(self):
+        """Inference thread: detect people and schedule Firebase updates"""
+        # Last detection result, reused on frames between inference runs
+        person_count, boxes, indexes, confidences = 0, [], (), []
+        stable_presence = False
         
         try:
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
+            self.pin_inference_thread()
+            
+            while not self.stop_event.is_set():
+                try:
+                    frame = self.frame_queue.get(timeout=1.0)
+                except Empty:
+                    continue
                 
-                # Detect people
-                person_count, boxes, indexes, confidences = self.detect_people(frame)
+                current_time = time.monotonic()  # Interval clock, unaffected by NTP/wall-clock jumps
                 
-                # Apply stability filter
-                stable_presence = self.stable_presence_detection(person_count)
+                # Check the scene on a fixed time schedule, independent of camera FPS
+                if current_time - self.last_motion_check >= self.inference_interval:
+                    self.last_motion_check = current_time
+                    
+                    # Only run YOLO on motion, or periodically to catch still people
+                    if (self.scene_changed(frame)
+                            or current_time - self.last_inference >= self.static_refresh_interval):
+                        person_count, boxes, indexes, confidences = self.detect_people(frame)
+                        self.last_inference = current_time
+                        
+                        # Apply stability filter
+                        stable_presence = self.stable_presence_detection(person_count)
                 
                 # Update Firebase every 2 seconds
-                current_time = time.time()
                 if current_time - self.last_update >= self.update_interval:
                     self.update_firebase(stable_presence, person_count)
                     self.last_update = current_time
                 
+                # Hand the frame and latest result to the display thread at the preview rate
+                if self.show_window and current_time - self.last_display >= self.display_interval:
+                    self.last_display = current_time
+                    put_latest(self.display_queue,
+                               (frame, person_count, boxes, indexes, confidences, stable_presence))
+                    
+        except Exception as e:
+            print(f"❌ Detection error: {e}")
+            self.stop_event.set()
+    
+    def open_camera(self):
+        """Open the camera, through the GStreamer pipeline in camera_source if one is given"""
+        # A pipeline negotiates format, size and rate in one step, e.g.
+        # "v4l2src device=/dev/video0 ! image/jpeg,width=640,height=480,framerate=30/1
+        #  ! jpegdec ! videoconvert ! appsink drop=true max-buffers=1"
+        if self.camera_source:
+            cap = cv2.VideoCapture(self.camera_source, cv2.CAP_GSTREAMER)
+            if cap.isOpened():
+                return cap
+            print("⚠️ GStreamer pipeline failed to open, falling back to the default camera")
+        
+        # Media Foundation on Windows, V4L2 directly on Linux
+        if sys.platform == "win32":
+            cap = cv2.VideoCapture(0, cv2.CAP_MSMF)
+        elif sys.platform.startswith("linux"):
+            cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+        else:
+            cap = cv2.VideoCapture(0)
+        
+        # Ask for MJPG so the camera sends compressed frames instead of raw YUY2
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Minimize lag
+        return cap
+    
+    def run_detection(self):
+        """Main detection loop"""
+        cap = self.open_camera()
+        
+        if not cap.isOpened():
+            print("❌ Error: Could not open camera")
+            return
+        
+        if self.show_window:
+            print("🎥 Camera started - Press 'q' to quit")
+        else:
+            print("🎥 Camera started (headless) - Press Ctrl+C to quit")
+        
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        if fourcc > 0:
+            print(f"🎞️ Capture format: {fourcc.to_bytes(4, 'little').decode('ascii', errors='replace')}")
+        
+        # Pipeline: capture thread -> inference thread -> Firebase uploader,
+        # the main thread only handles display
+        self.stop_event.clear()
+        capture_thread = threading.Thread(target=self.capture_frames, args=(cap,), daemon=True)
+        capture_thread.start()
+        inference_thread = threading.Thread(target=self.inference_loop, daemon=True)
+        inference_thread.start()
+        upload_thread = threading.Thread(target=self.firebase_uploader, daemon=True)
+        upload_thread.start()
+        
+        try:
+            while not self.stop_event.is_set():
+                # Headless mode has nothing to do here but wait for shutdown
+                if not self.show_window:
+                    self.stop_event.wait(0.5)
+                    continue
+                
+                try:
+                    frame, person_count, boxes, indexes, confidences, stable_presence = \
+                        self.display_queue.get(timeout=1.0)
+                except Empty:
+                    continue
+                
                 # Draw detections on frame
                 frame = self.draw_detections(frame, boxes, indexes, confidences)
                 
                 # Add status overlay
-                status_text = f"People: {person_count} | Presence: {stable_presence}"
-                cv2.putText(frame, status_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                frame = self.draw_status(frame, person_count, stable_presence)
                 
                 # Show frame
                 cv2.imshow('AI Presence Detection', frame)
@@ -193,24 +428,40 @@ class AIPresenceDetector:
         except KeyboardInterrupt:
             print("\n🛑 Detection stopped by user")
         finally:
+            self.stop_event.set()
+            capture_thread.join(timeout=1.0)
+            inference_thread.join(timeout=1.0)
             cap.release()
-            cv2.destroyAllWindows()
+            if self.show_window:
+                cv2.destroyAllWindows()
             print("👋 Camera released")
+            
+            # Release the camera before waiting on the network; a pending update is dropped
+            put_latest(self.upload_queue, None)
+            upload_thread.join(timeout=5.0)
+            self.session.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AI presence detection for Smart Classroom")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the preview window (e.g. on a server)")
+    args = parser.parse_args()
+    
     try:
         print("🚀 Starting AI Presence Detection...")
         
         # For development with emulator
         detector = AIPresenceDetector(
             firebase_url="http://localhost:9000",
-            room_id="roomA"
+            room_id="roomA",
+            show_window=not args.headless
         )
         
         # For production with real Firebase
         # detector = AIPresenceDetector(
         #     firebase_url="https://smartclassroom-af237-default-rtdb.firebaseio.com",
-        #     room_id="roomA"
+        #     room_id="roomA",
+        #     show_window=not args.headless
         # )
         
         detector.run_detection()
@@ -3,35 +3,101 @@ Simple AI Presence Detection using OpenCV built-in methods
 Alternative to YOLO for easier setup
 """
 
+import argparse
 import cv2
 import numpy as np
 import time
 import requests
+import sys
+import threading
 from datetime import datetime
+from queue import Queue, Empty
+from requests.adapters import HTTPAdapter
+
+def put_latest(q, item):
+    """Put item into a one-slot queue, dropping whatever is still waiting"""
+    try:
+        q.get_nowait()
+    except Empty:
+        pass
+    q.put(item)
 
 class SimplePresenceDetector:
-    def __init__(self, firebase_url="http://localhost:9000", room_id="roomA"):
+    # People detector shared by every instance (the SVM is loaded only once)
+    _hog = None
+    
+    @classmethod
+    def get_hog(cls):
+        """Return the shared HOG people detector, creating it on first use"""
+        if cls._hog is None:
+            hog = cv2.HOGDescriptor()
+            hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+            cls._hog = hog
+        return cls._hog
+    
+    def __init__(self, firebase_url="http://localhost:9000", room_id="roomA", show_window=True,
+                 heartbeat_interval=2.0):
         """Initialize hybrid presence detector with Firebase integration"""
         self.firebase_url = firebase_url
         self.room_id = room_id
+        self.state_url = f"{firebase_url}/lighting/{room_id}/state.json"
+        self.show_window = show_window  # Disable for headless/service deployments
+        
+        # Firebase uploads run on a background thread with a keep-alive session
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.upload_queue = Queue(maxsize=1)
         
         # Hybrid approach: HOG for accuracy + Motion for speed
-        self.hog = cv2.HOGDescriptor()
-        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
-        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+        self.hog = self.get_hog()
+        
+        # Motion: running-average background (set from the first frame)
+        self.background = None
+        self.background_alpha = 0.05  # How quickly the background adapts
+        self.motion_diff_threshold = 25  # Gray-level change that counts as motion
+        self.motion_pixel_threshold = 0  # 2% of the frame, set with the background
         
         # Timing control
         self.last_update = 0
-        self.update_interval = 2.0  # Update Firebase every 2 seconds
+        self.update_interval = 2.0  # Check for a presence change every 2 seconds
+        # Resend unchanged presence this often; the ESP32 and simulator overwrite the same
+        # state node every 2 s, so a longer period lets their presence win in between
+        self.heartbeat_interval = heartbeat_interval
+        self.last_sent_presence = None
+        self.last_heartbeat = 0
         self.last_hog_detection = 0
         self.hog_detection_interval = 1.0  # Run HOG every 1 second
         
         # Detection state management
         self.presence_history = []
         self.history_size = 3
-        self.last_person_detected = 0
+        self.last_person_detected = float("-inf")  # Never (monotonic clock may start near 0 at boot)
         self.person_timeout = 10.0  # Keep presence for 10 seconds after last detection
         
+        # Grayscale frame shared by motion and HOG detection (sized on first frame)
+        self.gray = None
+        
+        # Reused per-frame buffers so the loop doesn't allocate new arrays
+        self.small = np.empty((120, 160), np.uint8)  # HOG input (HOG thread only)
+        self.motion_half = None  # Motion pyrDown level 1 (160x120 at 320x240)
+        self.motion_small = None  # Motion pyrDown level 2 (80x60 at 320x240)
+        self.background_u8 = None
+        self.diff = None
+        self.fg_mask = None
+        
+        # Pre-rendered PRESENT/EMPTY indicators keyed by presence
+        self.status_cache = {}
+        
+        # Capture pipeline: only the newest frame is kept for detection
+        self.frame_queue = Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        
+        # HOG runs on its own thread; the loop reads the last published result
+        self.hog_queue = Queue(maxsize=1)
+        self.hog_lock = threading.Lock()
+        self.hog_result = (False, [])
+        
         print("🤖 Hybrid Presence Detector initialized")
         print(f"📍 Room: {room_id}")
         print(f"🔗 Firebase: {firebase_url}")
@@ -56,25 +122,35 @@ class SimplePresenceDetector:
     def detect_presence_fast(self, frame):
         """Fast motion-based presence detection"""
         try:
-            # Apply background subtraction
-            fg_mask = self.bg_subtractor.apply(frame)
+            if self.background is None or self.background.shape != frame.shape:
+                self.background = frame.astype(np.float32)
+                self.background_u8 = np.empty_like(frame)
+                self.diff = np.empty_like(frame)
+                self.fg_mask = np.empty_like(frame)
+                self.motion_pixel_threshold = frame.size // 50  # 2% of frame
+            
+            # Compare against the running average, then fold the frame into it
+            cv2.convertScaleAbs(self.background, dst=self.background_u8)
+            cv2.absdiff(frame, self.background_u8, dst=self.diff)
+            cv2.accumulateWeighted(frame, self.background, self.background_alpha)
+            cv2.threshold(self.diff, self.motion_diff_threshold, 255, cv2.THRESH_BINARY, dst=self.fg_mask)
             
             # Count non-zero pixels (motion pixels)
-            motion_pixels = cv2.countNonZero(fg_mask)
+            motion_pixels = cv2.countNonZero(self.fg_mask)
             
             # Simple threshold: if enough motion pixels, assume presence
-            motion_threshold = frame.shape[0] * frame.shape[1] * 0.02  # 2% of frame
-            
-            has_presence = motion_pixels > motion_threshold
+            has_presence = motion_pixels > self.motion_pixel_threshold
             
             return has_presence, motion_pixels
         except Exception as e:
             print(f"Motion detection error: {e}")
             return False, 0
     
-    def hybrid_presence_detection(self, hog_detected, motion_detected):
-        """Hybrid detection with timeout for still people"""
-        current_time = time.time()
+    def hybrid_presence_detection(self, hog_detected, motion_detected=None, current_time=None):
+        """Hybrid detection with timeout for still people (motion_detected=None: motion skipped)"""
+        # Use the caller's timestamp so the timeout matches its motion-skip decision
+        if current_time is None:
+            current_time = time.monotonic()
         
         # If HOG detects a person, update last detection time
         if hog_detected:
@@ -86,31 +162,55 @@ class SimplePresenceDetector:
             return True
         
         # If no recent HOG detection, use motion as backup
-        return motion_detected
+        return bool(motion_detected)
     
-    def update_firebase(self, presence, detection_method="Hybrid"):
-        """Update Firebase with presence data"""
-        try:
-            timestamp = int(time.time() * 1000)
-            
-            # Prepare data for Firebase
-            data = {
-                "presence": presence,
-                "ts": timestamp,
-                "source": f"AI_Camera_{detection_method}"
-            }
-            
-            # Update state
-            state_url = f"{self.firebase_url}/lighting/{self.room_id}/state.json"
-            response = requests.patch(state_url, json=data, timeout=3)
+    def update_firebase(self, presence, detection_method="Hybrid", current_time=None):
+        """Queue presence data for the uploader when it changed or the heartbeat is due"""
+        # Use the caller's timestamp so the heartbeat lines up with its 2 s check
+        if current_time is None:
+            current_time = time.monotonic()
+        
+        # Skip unchanged presence between heartbeats (the method string holds a
+        # live countdown, so only presence itself counts as a change)
+        if (presence == self.last_sent_presence and
+                current_time - self.last_heartbeat < self.heartbeat_interval):
+            return
+        self.last_sent_presence = presence
+        self.last_heartbeat = current_time
+        
+        timestamp = int(time.time() * 1000)  # Wall-clock time for the dashboard
+        
+        # Prepare data for Firebase
+        data = {
+            "presence": presence,
+            "ts": timestamp,
+            "source": f"AI_Camera_{detection_method}"
+        }
+        
+        # Never block detection on the network; only the latest state matters
+        put_latest(self.upload_queue, (data, detection_method))
+    
+    def firebase_uploader(self):
+        """Upload thread: send queued state updates until a None sentinel"""
+        while True:
+            item = self.upload_queue.get()
+            if item is None:
+                break
+            data, detection_method = item
             
-            if response.status_code == 200:
-                print(f"✅ Firebase updated: presence={presence} ({detection_method})")
-            else:
-                print(f"❌ Firebase update failed: {response.status_code}")
+            try:
+                # Update state
+                response = self.session.patch(self.state_url, json=data, timeout=3)
                 
-        except Exception as e:
-            print(f"❌ Firebase error: {e}")
+                if response.status_code == 200:
+                    print(f"✅ Firebase updated: presence={data['presence']} ({detection_method})")
+                else:
+                    print(f"❌ Firebase update failed: {response.status_code}")
+                    self.last_sent_presence = None  # Retry on the next check
+                    
+            except Exception as e:
+                print(f"❌ Firebase error: {e}")
+                self.last_sent_presence = None  # Retry on the next check
     
     def draw_detections(self, frame, boxes, method="HOG"):
         """Draw detection boxes on frame"""
@@ -124,10 +224,65 @@ class SimplePresenceDetector:
         
         return frame
     
+    def draw_status(self, frame, presence):
+        """Blit the cached PRESENT/EMPTY indicator onto frame"""
+        if presence not in self.status_cache:
+            # Render the box and text once on a black patch and remember which pixels they cover
+            overlay = np.zeros((52, 122, 3), np.uint8)
+            if presence:
+                cv2.rectangle(overlay, (10, 10), (120, 50), (0, 255, 0), 2)
+                cv2.putText(overlay, "PRESENT", (15, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+            else:
+                cv2.rectangle(overlay, (10, 10), (120, 50), (0, 0, 255), 2)
+                cv2.putText(overlay, "EMPTY", (25, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+            self.status_cache[presence] = (overlay, overlay.any(axis=2, keepdims=True))
+        
+        overlay, mask = self.status_cache[presence]
+        region = frame[:overlay.shape[0], :overlay.shape[1]]
+        rows, cols = region.shape[:2]
+        np.copyto(region, overlay[:rows, :cols], where=mask[:rows, :cols])
+        return frame
+    
+    def capture_frames(self, cap):
+        """Capture thread: keep only the latest frame in the queue"""
+        while not self.stop_event.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                self.stop_event.set()
+                break
+            
+            # Drop the stale frame so detection never falls behind the camera
+            put_latest(self.frame_queue, frame)
+    
+    def hog_worker(self):
+        """HOG thread: detect people in queued grayscale snapshots"""
+        while not self.stop_event.is_set():
+            try:
+                gray = self.hog_queue.get(timeout=1.0)
+            except Empty:
+                continue
+            
+            # Use smaller frame for HOG processing
+            cv2.resize(gray, (160, 120), dst=self.small)
+            hog_detected, boxes = self.detect_people_hog_fast(self.small)
+            # Scale boxes back to original size
+            boxes = [(x*2, y*2, w*2, h*2) for x, y, w, h in boxes]
+            
+            with self.hog_lock:
+                self.hog_result = (hog_detected, boxes)
+    
     def run_detection(self):
         """Hybrid detection loop - HOG + Motion + Timeout for still people"""
         # Initialize camera with balanced settings for performance and quality
-        cap = cv2.VideoCapture(0)
+        # (Media Foundation on Windows, V4L2 directly on Linux)
+        if sys.platform == "win32":
+            cap = cv2.VideoCapture(0, cv2.CAP_MSMF)
+        elif sys.platform.startswith("linux"):
+            cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+        else:
+            cap = cv2.VideoCapture(0)
+        # Ask for MJPG so the camera sends compressed frames instead of raw YUY2
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, 320)  # Balanced resolution
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
         cap.set(cv2.CAP_PROP_FPS, 20)  # Higher FPS for smoother video
@@ -138,10 +293,25 @@ class SimplePresenceDetector:
             input("Press Enter to exit...")
             return
         
-        print("🎥 Camera started - Press 'q' to quit")
+        if self.show_window:
+            print("🎥 Camera started - Press 'q' to quit")
+        else:
+            print("🎥 Camera started (headless) - Press Ctrl+C to quit")
         print("📖 Method: Hybrid HOG + Motion + Timeout")
         print("⚡ Settings: 320x240 @ 20fps")
         print("🎯 Features: Detects still people + motion + 10s timeout")
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        if fourcc > 0:
+            print(f"🎞️ Capture format: {fourcc.to_bytes(4, 'little').decode('ascii', errors='replace')}")
+        
+        # Read frames on a separate thread so capture overlaps with detection
+        self.stop_event.clear()
+        capture_thread = threading.Thread(target=self.capture_frames, args=(cap,), daemon=True)
+        capture_thread.start()
+        upload_thread = threading.Thread(target=self.firebase_uploader, daemon=True)
+        upload_thread.start()
+        hog_thread = threading.Thread(target=self.hog_worker, daemon=True)
+        hog_thread.start()
         
         try:
             frame_count = 0
@@ -150,29 +320,44 @@ class SimplePresenceDetector:
             detection_method = "Starting"
             boxes = []
             
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
+            while not self.stop_event.is_set():
+                try:
+                    frame = self.frame_queue.get(timeout=1.0)
+                except Empty:
+                    continue
                 
                 frame_count += 1
-                current_time = time.time()
+                current_time = time.monotonic()  # Interval clock, unaffected by NTP/wall-clock jumps
                 
-                # Always do fast motion detection
-                motion_detected, motion_level = self.detect_presence_fast(frame)
+                # Convert to grayscale once; motion and HOG both only need one channel
+                if self.gray is None or self.gray.shape != frame.shape[:2]:
+                    h, w = frame.shape[:2]
+                    self.gray = np.empty((h, w), np.uint8)
+                    self.motion_half = np.empty(((h + 1) // 2, (w + 1) // 2), np.uint8)
+                    self.motion_small = np.empty(((h + 3) // 4, (w + 3) // 4), np.uint8)
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
                 
-                # Do HOG detection every second (not every frame)
+                # Motion can't change the result while a recent HOG hit keeps presence
+                # latched, so only run it then when a Firebase update is due
+                in_timeout = current_time - self.last_person_detected < self.person_timeout
+                if in_timeout and current_time - self.last_update < self.update_interval:
+                    motion_detected, motion_level = None, 0
+                else:
+                    # Occupancy doesn't need full resolution; 1/16 of the pixels is enough
+                    cv2.pyrDown(self.gray, dst=self.motion_half)
+                    cv2.pyrDown(self.motion_half, dst=self.motion_small)
+                    motion_detected, motion_level = self.detect_presence_fast(self.motion_small)
+                
+                # Hand HOG a snapshot every second (not every frame) without waiting on it
                 if current_time - self.last_hog_detection >= self.hog_detection_interval:
-                    # Use smaller frame for HOG processing
-                    small_frame = cv2.resize(frame, (160, 120))
-                    hog_detected, boxes = self.detect_people_hog_fast(small_frame)
-                    # Scale boxes back to original size
-                    boxes = [(x*2, y*2, w*2, h*2) for x, y, w, h in boxes]
+                    put_latest(self.hog_queue, self.gray.copy())
                     self.last_hog_detection = current_time
-                    detection_method = "HOG" if hog_detected else "Motion"
+                
+                with self.hog_lock:
+                    hog_detected, boxes = self.hog_result
                 
                 # Hybrid presence detection with timeout
-                final_presence = self.hybrid_presence_detection(hog_detected, motion_detected)
+                final_presence = self.hybrid_presence_detection(hog_detected, motion_detected, current_time)
                 
                 # Determine display method
                 time_since_hog = current_time - self.last_person_detected
@@ -186,23 +371,21 @@ class SimplePresenceDetector:
                 else:
                     detection_method = "None"
                 
-                # Update Firebase every 2 seconds
+                # Check every 2 seconds; update_firebase sends on a change or a due heartbeat
                 if current_time - self.last_update >= self.update_interval:
-                    self.update_firebase(final_presence, detection_method)
+                    self.update_firebase(final_presence, detection_method, current_time)
                     self.last_update = current_time
                 
+                # Headless mode skips all drawing and GUI calls
+                if not self.show_window:
+                    continue
+                
                 # Draw detection boxes if available
                 if len(boxes) > 0 and hog_detected:
-                    for (x, y, w, h) in boxes:
-                        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                    frame = self.draw_detections(frame, boxes, "HOG")
                 
                 # Visual status indicator
-                if final_presence:
-                    cv2.rectangle(frame, (10, 10), (120, 50), (0, 255, 0), 2)
-                    cv2.putText(frame, "PRESENT", (15, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                else:
-                    cv2.rectangle(frame, (10, 10), (120, 50), (0, 0, 255), 2)
-                    cv2.putText(frame, "EMPTY", (25, 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+                frame = self.draw_status(frame, final_presence)
                 
                 # Status overlay
                 status_text = f"Method: {detection_method} | Motion: {motion_level}"
@@ -218,18 +401,33 @@ class SimplePresenceDetector:
         except KeyboardInterrupt:
             print("\n🛑 Detection stopped by user")
         finally:
+            self.stop_event.set()
+            capture_thread.join(timeout=1.0)
+            hog_thread.join(timeout=1.0)
             cap.release()
-            cv2.destroyAllWindows()
+            if self.show_window:
+                cv2.destroyAllWindows()
             print("👋 Camera released")
+            
+            # Release the camera before waiting on the network; a pending update is dropped
+            put_latest(self.upload_queue, None)
+            upload_thread.join(timeout=5.0)
+            self.session.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simple AI presence detection for Smart Classroom")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the preview window (e.g. on a server)")
+    args = parser.parse_args()
+    
     try:
         print("🚀 Starting Simple AI Presence Detection...")
         print("This uses OpenCV built-in methods (no external model files needed)")
         
         detector = SimplePresenceDetector(
             firebase_url="http://localhost:9000",
-            room_id="roomA"
+            room_id="roomA",
+            show_window=not args.headless
         )
         
         detector.run_detection()